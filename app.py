@@ -4,10 +4,17 @@ import cv2
 import numpy as np
 import os
 from utils.image_processor import ImageProcessor
-from utils.model_loader import ModelLoader
+from utils.model_loader import ModelLoader, SPIRAL_INPUT_SHAPE, WAVE_INPUT_SHAPE
 from utils.report_generator import ReportGenerator
 import sys
 import json
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from werkzeug.exceptions import RequestEntityTooLarge
 
 # Create required directories
 Path("static/css").mkdir(parents=True, exist_ok=True)
@@ -16,6 +23,7 @@ Path("static/reports").mkdir(parents=True, exist_ok=True)
 Path("utils").mkdir(parents=True, exist_ok=True)
 
 app = Flask(__name__, static_url_path='/static')
+app.config['MAX_CONTENT_LENGTH'] = 4 * 1024 * 1024  # Reject oversized uploads before decoding
 
 # Initialize model loader and image processor
 print("Initializing model loader and image processor...")
@@ -25,7 +33,105 @@ if not model_loader.load_models():
     sys.exit(1)
 print("Models loaded successfully")
 
-image_processor = ImageProcessor()
+image_processor = ImageProcessor(model_loader)  # Also warms up the Grad-CAM graphs
+print("Grad-CAM warmup complete")
+
+# Shared across requests so its analysis cache persists. Report images are written next to
+# the reports and served by the static route.
+report_generator = ReportGenerator(image_processor=image_processor, image_dir='static/reports',
+                                   image_url=f'{app.static_url_path}/reports')
+
+# Per-request reports and their images are deleted once they are older than this
+REPORT_TTL_SECONDS = 30 * 60
+REPORT_SWEEP_INTERVAL_SECONDS = 5 * 60
+REPORT_NAME_PATTERN = re.compile(r'[0-9a-f]{32}(\.html|_[a-z_]+\.jpg)(\.tmp)?')
+# How long the report route waits for a report that is still being written
+REPORT_WAIT_SECONDS = 10
+
+def sweep_reports():
+    """Periodically remove expired per-request reports and images from static/reports."""
+    while True:
+        cutoff = time.time() - REPORT_TTL_SECONDS
+        try:
+            for report_path in Path('static/reports').iterdir():
+                if not REPORT_NAME_PATTERN.fullmatch(report_path.name):
+                    continue
+                try:
+                    if report_path.stat().st_mtime < cutoff:
+                        report_path.unlink()
+                except FileNotFoundError:
+                    pass  # Already removed by another worker
+        except OSError as e:
+            # Keep the sweeper alive; the next pass retries
+            print(f"Error sweeping reports: {str(e)}", file=sys.stderr)
+        time.sleep(REPORT_SWEEP_INTERVAL_SECONDS)
+
+threading.Thread(target=sweep_reports, daemon=True).start()
+
+# Reports are written off the request path, shared across requests.
+# Writes still in flight in this process, by request id, so the report route can wait on them.
+report_writer = ThreadPoolExecutor(max_workers=1)
+pending_reports = {}
+pending_reports_lock = threading.Lock()
+
+def write_report(report_path, report_html):
+    """Write a report atomically so it is never served half-written."""
+    tmp_path = f'{report_path}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(report_html)
+    os.replace(tmp_path, report_path)
+
+def report_written(req_id, future):
+    """Drop a finished write from the pending map and log it if it failed."""
+    with pending_reports_lock:
+        pending_reports.pop(req_id, None)
+    error = future.exception()
+    if error is not None:
+        print(f"Error writing report {req_id}: {str(error)}", file=sys.stderr)
+
+def submit_report(req_id, report_path, report_html):
+    """Write a report in the background, tracking it until the write finishes."""
+    future = report_writer.submit(write_report, report_path, report_html)
+    with pending_reports_lock:
+        pending_reports[req_id] = future
+    future.add_done_callback(partial(report_written, req_id))  # Runs at once if already done
+
+JPEG_MAGIC = b'\xff\xd8\xff'
+# SOFn markers, which carry the frame size (0xC4, 0xC8 and 0xCC share the range but are not frames)
+JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+def jpeg_size(data):
+    """Read (width, height) from a JPEG frame header without decoding. Returns None if not found."""
+    i = 2
+    while i + 9 <= len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:  # Fill byte before a marker
+            i += 1
+            continue
+        if marker in JPEG_SOF_MARKERS:
+            return int.from_bytes(data[i + 7:i + 9], 'big'), int.from_bytes(data[i + 5:i + 7], 'big')
+        i += 2 + int.from_bytes(data[i + 2:i + 4], 'big')
+    return None
+
+def decode_upload(file_storage, min_size):
+    """Decode an uploaded image in memory. Returns None if it isn't a readable image.
+    A JPEG whose sides are both at least twice the larger side of min_size (width, height), the
+    size it gets resized to for the model, is decoded at half resolution, which libjpeg does
+    during decoding. The header size ignores EXIF orientation, so comparing both sides against
+    the larger target side keeps the check valid for rotated photos. Everything else, PNG
+    included, is decoded once at full resolution.
+    """
+    data = file_storage.read()
+    if not data:
+        return None
+    flags = cv2.IMREAD_COLOR
+    if data.startswith(JPEG_MAGIC):
+        size = jpeg_size(data)
+        if size is not None and min(size) >= 2 * max(min_size):
+            flags = cv2.IMREAD_REDUCED_COLOR_2
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flags)
 
 # Routes for HTML pages
 @app.route('/')
@@ -54,6 +160,8 @@ def contact():
 
 @app.route('/analyze', methods=['POST'])
 def analyze():
+    # Unique id so concurrent analyses never share a report file
+    req_id = uuid.uuid4().hex
     try:
         # Get uploaded files
         spiral_file = request.files.get('spiral')
@@ -80,16 +188,9 @@ def analyze():
                 'message': 'Invalid user information. Please provide name, age (18-60), and gender.'
             }), 400
 
-        # Save uploaded files
-        spiral_path = os.path.join('static/uploads', 'spiral.png')
-        wave_path = os.path.join('static/uploads', 'wave.png')
-        
-        spiral_file.save(spiral_path)
-        wave_file.save(wave_path)
-
-        # Read images
-        spiral_img = cv2.imread(spiral_path)
-        wave_img = cv2.imread(wave_path)
+        # Decode images straight from the upload streams, without a disk round-trip
+        spiral_img = decode_upload(spiral_file, (SPIRAL_INPUT_SHAPE[2], SPIRAL_INPUT_SHAPE[1]))
+        wave_img = decode_upload(wave_file, (WAVE_INPUT_SHAPE[2], WAVE_INPUT_SHAPE[1]))
 
         if spiral_img is None or wave_img is None:
             return jsonify({
@@ -97,21 +198,26 @@ def analyze():
                 'message': 'Error reading uploaded images'
             }), 400
 
-        # Generate report
-        report_generator = ReportGenerator(image_processor=image_processor, model_loader=model_loader)
-        report_html = report_generator.generate_report(spiral_img, wave_img, user_info)
+        # Generate report, writing its images as files so the HTML stays small
+        report_html = report_generator.generate_report(spiral_img, wave_img, user_info,
+                                                       emit_mode='files', report_id=req_id)
 
-        # Save report
-        report_path = os.path.join('static/reports', 'report.html')
-        with open(report_path, 'w') as f:
-            f.write(report_html)
+        # Save report in the background and return its URL right away
+        report_path = os.path.join('static/reports', f'{req_id}.html')
+        submit_report(req_id, report_path, report_html)
 
         return jsonify({
             'status': 'success',
             'message': 'Analysis complete',
-            'report_url': url_for('static', filename='reports/report.html')
+            'report_url': url_for('report', req_id=req_id)
         })
 
+    except RequestEntityTooLarge:
+        return jsonify({
+            'status': 'error',
+            'message': 'Uploaded drawings are too large. The maximum total size is 4 MB.'
+        }), 413
+
     except Exception as e:
         print(f"Error in analyze route: {str(e)}", file=sys.stderr)
         return jsonify({
@@ -119,6 +225,31 @@ def analyze():
             'message': str(e)
         }), 500
 
+@app.route('/reports/<req_id>')
+def report(req_id):
+    """Serve a generated report, waiting for it if it is still being written."""
+    report_path = os.path.join('static/reports', f'{req_id}.html')
+    if REPORT_NAME_PATTERN.fullmatch(f'{req_id}.html'):
+        with pending_reports_lock:
+            future = pending_reports.get(req_id)
+        if future is not None:
+            try:
+                future.result(timeout=REPORT_WAIT_SECONDS)
+            except Exception:
+                pass  # Logged by report_written; the missing file gives a 404 below
+        else:
+            # Written by another worker process: wait only while its tmp file shows a write in flight
+            deadline = time.time() + REPORT_WAIT_SECONDS
+            while os.path.exists(f'{report_path}.tmp') and time.time() < deadline:
+                time.sleep(0.05)
+        if os.path.exists(report_path):
+            return send_file(report_path)
+
+    return jsonify({
+        'status': 'error',
+        'message': 'Report not found'
+    }), 404
+
 # Form submission endpoints
 @app.route('/submit-contact', methods=['POST'])
 def submit_contact():
@@ -179,4 +310,8 @@ def download_guide(guide_type):
         }), 500
 
 if __name__ == '__main__':
+    # Development server only. In production run under gunicorn with the app preloaded,
+    # so the models are loaded once and shared copy-on-write across the forked workers:
+    #   gunicorn -w 4 --preload -k gthread --threads 2 -b 0.0.0.0:5003 app:app
+    # On a GPU use a single worker (-w 1 --threads N), since the GPU context is per-process.
     app.run(debug=True, port=5003)
\ No newline at end of file
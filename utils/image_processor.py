@@ -1,111 +1,207 @@
+import threading
 import cv2
 import numpy as np
 import tensorflow as tf
-from tensorflow.keras.models import Model
+from utils.model_loader import SPIRAL_INPUT_SHAPE, WAVE_INPUT_SHAPE
+
+# pyvips is optional: a faster JPEG encoder when libvips is installed, OpenCV otherwise
+try:
+    import pyvips
+except (ImportError, OSError):  # OSError when the module is present but libvips is not
+    pyvips = None
+
+# Number of warmup passes run at startup so the first request doesn't pay lazy-init cost
+WARMUP_RUNS = 2
+
+# 256-entry BGR lookup table for COLORMAP_JET, shaped (256, 1, 3)
+JET_LUT = cv2.applyColorMap(np.arange(256, dtype=np.uint8).reshape(256, 1), cv2.COLORMAP_JET)
 
 class ImageProcessor:
-    def __init__(self):
-        pass
+    def __init__(self, model_loader=None):
+        self.model_loader = model_loader
+        # Per-thread scratch buffers for fixed-size intermediates that never leave a call
+        self._local = threading.local()
+        # Traced Grad-CAM functions, keyed by id() of the grad-model they close over
+        self._gradcam_fns = {}
+        self._spiral_gradcam_tf = None
+        self._wave_gradcam_tf = None
+        if model_loader is not None:
+            self._spiral_gradcam_tf = self._get_gradcam_fn(
+                model_loader.get_spiral_gradcam_model(), SPIRAL_INPUT_SHAPE)
+            self._wave_gradcam_tf = self._get_gradcam_fn(
+                model_loader.get_wave_gradcam_model(), WAVE_INPUT_SHAPE)
+            self.warmup()
+
+    def warmup(self, runs=WARMUP_RUNS):
+        """Trace and XLA-compile the Grad-CAM graphs before the first request.
+        This is the only warmup: ModelLoader.load_models leaves the models loaded but cold.
+        """
+        for _ in range(runs):
+            self._spiral_gradcam_tf(tf.zeros(SPIRAL_INPUT_SHAPE), tf.constant(-1, dtype=tf.int64))
+            self._wave_gradcam_tf(tf.zeros(WAVE_INPUT_SHAPE), tf.constant(-1, dtype=tf.int64))
+
+    def _scratch(self, name, shape):
+        """Get this thread's reusable uint8 buffer for the given purpose and shape.
+        Buffers are kept for the thread's lifetime, so only request shapes fixed by the model
+        input sizes, never ones that follow the upload size.
+        """
+        buffers = getattr(self._local, 'buffers', None)
+        if buffers is None:
+            buffers = self._local.buffers = {}
+        key = (name, shape)
+        buffer = buffers.get(key)
+        if buffer is None:
+            buffer = buffers[key] = np.empty(shape, dtype=np.uint8)
+        return buffer
+
+    def _preprocess(self, img, target_size):
+        """Convert to grayscale, resize into the scratch buffer and invert."""
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)  # Upload-sized, so not worth caching
+        # Resize the single-channel uint8 image so OpenCV dispatches to its SIMD kernels;
+        # INTER_AREA when shrinking, the default bilinear when enlarging
+        shrinking = gray.shape[1] >= target_size[0] and gray.shape[0] >= target_size[1]
+        interpolation = cv2.INTER_AREA if shrinking else cv2.INTER_LINEAR
+        resized = cv2.resize(gray, target_size, dst=self._scratch('resized', (target_size[1], target_size[0])),
+                             interpolation=interpolation)
+        return np.subtract(255, resized, dtype=np.uint8)  # Invert colors
 
     def process_spiral(self, img):
         """Process spiral drawing image."""
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        gray = cv2.resize(gray, (256, 256))
-        gray = 255 - gray  # Invert colors
-        return gray
+        return self._preprocess(img, (256, 256))
 
     def process_wave(self, img):
         """Process wave drawing image."""
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        gray = cv2.resize(gray, (550, 250))
-        gray = 255 - gray  # Invert colors
-        return gray
-
-    def make_spiral_gradcam(self, img_array, model, last_conv_layer_name="conv2d_3", pred_index=None):
-        """Generate Grad-CAM heatmap for spiral model.
-        Spiral model architecture:
-        - 4 conv layers (32->64->128->256 filters)
-        - Using last conv layer (conv2d_3) with 256 filters
+        return self._preprocess(img, (550, 250))
+
+    @staticmethod
+    def _build_gradcam_fn(grad_model, input_shape):
+        """Trace the Grad-CAM computation for a grad-model into a single XLA-compiled graph.
+        The returned function takes (img_array, pred_index) and returns (predictions, heatmap) from a
+        single forward pass, with the heatmap upsampled to the input resolution and color-mapped
+        with JET as a BGR uint8 image; a negative pred_index selects the top predicted class.
         """
-        grad_model = Model(
-            inputs=model.input,
-            outputs=[model.get_layer(last_conv_layer_name).output, model.output]
-        )
+        jet_lut = tf.constant(JET_LUT.reshape(256, 3))
+        output_size = input_shape[1:3]
 
-        with tf.GradientTape() as tape:
-            conv_outputs, predictions = grad_model(img_array)
-            if pred_index is None:
-                pred_index = tf.argmax(predictions[0])
-            class_channel = predictions[:, pred_index]
-
-        grads = tape.gradient(class_channel, conv_outputs)
-        pooled_grads = tf.reduce_mean(grads, axis=(0, 1, 2))
-
-        conv_outputs = conv_outputs[0]
-        heatmap = conv_outputs @ pooled_grads[..., tf.newaxis]
-        heatmap = tf.squeeze(heatmap)
-
-        # Normalize using the spiral model's scale
-        heatmap = tf.maximum(heatmap, 0) / tf.reduce_max(heatmap + 1e-8)
-        return heatmap.numpy()
-
-    def make_wave_gradcam(self, img_array, model, last_conv_layer_name="convo_3", pred_index=None):
-        """Generate Grad-CAM heatmap for wave model using the original implementation."""
-        grad_model = Model(
-            inputs=model.input,  # Fixed input layer
-            outputs=[model.get_layer(last_conv_layer_name).output, model.output]
+        @tf.function(
+            input_signature=[tf.TensorSpec(input_shape, tf.float32), tf.TensorSpec((), tf.int64)],
+            jit_compile=True
         )
+        def gradcam(img_array, pred_index):
+            with tf.GradientTape() as tape:
+                conv_outputs, predictions = grad_model(img_array, training=False)
+                pred_index = tf.where(pred_index < 0, tf.argmax(predictions[0]), pred_index)
+                class_channel = tf.gather(predictions, pred_index, axis=1)
+
+            grads = tape.gradient(class_channel, conv_outputs)
+            # Conv outputs are float16 when the models run under mixed precision
+            conv_outputs = tf.cast(conv_outputs, tf.float32)
+            pooled_grads = tf.reduce_mean(tf.cast(grads, tf.float32), axis=(0, 1, 2))
+
+            heatmap = tf.nn.relu(tf.einsum('hwc,c->hw', conv_outputs[0], pooled_grads))
+            heatmap = tf.math.divide_no_nan(heatmap, tf.reduce_max(heatmap))
+
+            # Upsample and color-map in-graph so only the final uint8 image is copied to the host
+            heatmap = tf.image.resize(heatmap[tf.newaxis, ..., tf.newaxis], output_size, method='bilinear')
+            indices = tf.clip_by_value(tf.cast(heatmap[0, ..., 0] * 255.0, tf.int32), 0, 255)
+            return tf.cast(predictions[0], tf.float32), tf.gather(jet_lut, indices)
+
+        return gradcam
+
+    def _get_gradcam_fn(self, grad_model, input_shape):
+        """Get the traced Grad-CAM function for a grad-model, building it on first use."""
+        gradcam_fn = self._gradcam_fns.get(id(grad_model))
+        if gradcam_fn is None:
+            gradcam_fn = self._build_gradcam_fn(grad_model, input_shape)
+            self._gradcam_fns[id(grad_model)] = gradcam_fn
+        return gradcam_fn
+
+    @staticmethod
+    def _run_gradcam(gradcam_fn, img_array, pred_index):
+        """Run a traced Grad-CAM function and return (predictions, colored heatmap) as NumPy arrays."""
+        if pred_index is None:
+            pred_index = -1
+        predictions, heatmap = gradcam_fn(tf.constant(img_array, dtype=tf.float32),
+                                          tf.constant(pred_index, dtype=tf.int64))
+        return predictions.numpy(), heatmap.numpy()
+
+    def predict_and_gradcam(self, img_array, is_wave=False):
+        """Get (probabilities, colored Grad-CAM heatmap) for a prepared image from one forward pass."""
+        if self.model_loader is None:
+            raise RuntimeError("ImageProcessor needs a ModelLoader to analyze drawings")
+        if is_wave:
+            gradcam_fn = self._get_gradcam_fn(self.model_loader.get_wave_gradcam_model(), WAVE_INPUT_SHAPE)
+        else:
+            gradcam_fn = self._get_gradcam_fn(self.model_loader.get_spiral_gradcam_model(), SPIRAL_INPUT_SHAPE)
+        return self._run_gradcam(gradcam_fn, img_array, None)
 
-        with tf.GradientTape() as tape:
-            conv_outputs, predictions = grad_model(img_array)
-            if pred_index is None:
-                pred_index = tf.argmax(predictions[0])
-            class_channel = predictions[:, pred_index]
-
-        grads = tape.gradient(class_channel, conv_outputs)
-        pooled_grads = tf.reduce_mean(grads, axis=(0, 1, 2))
-
-        conv_outputs = conv_outputs[0]
-        heatmap = conv_outputs @ pooled_grads[..., tf.newaxis]
-        heatmap = tf.squeeze(heatmap)
-
-        # Normalize and enhance contrast
-        heatmap = tf.maximum(heatmap, 0)
-        heatmap = heatmap / (tf.reduce_max(heatmap) + 1e-10)
-        return heatmap.numpy()
-
-    def overlay_heatmap(self, heatmap, image, alpha=None, is_wave=False):
-        """Overlay heatmap on the original image."""
+    def blend_heatmap(self, heatmap_color, image, alpha=None, is_wave=False, dst=None):
+        """Blend an already color-mapped heatmap of the same size onto the original image."""
         if alpha is None:
             alpha = 0.7 if is_wave else 0.4  # Higher alpha for wave to make it more visible
 
-        # Resize and enhance heatmap
-        heatmap = cv2.resize(heatmap, (image.shape[1], image.shape[0]))
-        heatmap = np.uint8(255 * heatmap)
-        
-        # Apply Gaussian blur with smaller kernel for sharper edges
-        heatmap = cv2.GaussianBlur(heatmap, (3, 3), 0)
-        
-        # Apply color mapping with enhanced contrast
-        heatmap_color = cv2.applyColorMap(heatmap, cv2.COLORMAP_JET)
-
-        if len(image.shape) == 2:
-            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
-
-        # Create the overlay with enhanced contrast
-        superimposed_img = cv2.addWeighted(heatmap_color, alpha, image, 1 - alpha, 0)
-        return superimposed_img
+        if image.ndim == 2:
+            height, width = image.shape  # Matches the heatmap, so always a model input size
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR, dst=self._scratch('bgr', (height, width, 3)))
+
+        # Blend in one pass, into a fresh array unless the caller provides dst
+        return cv2.addWeighted(heatmap_color, alpha, image, 1 - alpha, 0, dst=dst)
+
+    @staticmethod
+    def _encode_jpeg(img):
+        """Encode an OpenCV image (BGR or grayscale) into a bytes-like JPEG buffer."""
+        if pyvips is not None:
+            img = np.ascontiguousarray(img)
+            bands = 1 if img.ndim == 2 else img.shape[2]
+            vimg = pyvips.Image.new_from_memory(img.data, img.shape[1], img.shape[0], bands, 'uchar')
+            if bands == 3:
+                vimg = vimg[2].bandjoin([vimg[1], vimg[0]])  # libvips expects RGB
+            return vimg.write_to_buffer('.jpg[Q=85]')
+
+        ok, buf = cv2.imencode('.jpg', img, [int(cv2.IMWRITE_JPEG_QUALITY), 85])
+        if not ok:
+            raise ValueError("Failed to encode image")
+        return buf  # Contiguous uint8 array; written or base64-encoded in place without a bytes copy
+
+    def encode_jpeg(self, img, max_size=None):
+        """Encode an OpenCV image as a JPEG buffer.
+        If max_size is given, the image is first shrunk so its longest side fits; never enlarged.
+        """
+        if max_size is not None:
+            height, width = img.shape[:2]
+            scale = max_size / max(height, width)
+            if scale < 1:
+                size = (round(width * scale), round(height * scale))
+                img = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+        return self._encode_jpeg(img)
+
+    def overlay_and_encode(self, heatmap_color, image, alpha=None, is_wave=False, max_size=None):
+        """Blend a color-mapped heatmap onto the image and encode it straight to a JPEG buffer,
+        shrunk to fit max_size like encode_jpeg.
+        The blended overlay only lives in a scratch buffer, never as a returned array.
+        """
+        overlay = self.blend_heatmap(heatmap_color, image, alpha=alpha, is_wave=is_wave,
+                                     dst=self._scratch('overlay', image.shape[:2] + (3,)))
+        return self.encode_jpeg(overlay, max_size=max_size)
 
     def prepare_image_for_prediction(self, img, is_wave=False):
         """Prepare image for model prediction."""
-        if is_wave:
-            processed = self.process_wave(img)
-            target_size = (550, 250)
-        else:
-            processed = self.process_spiral(img)
-            target_size = (256, 256)
-        
-        processed = cv2.resize(processed, target_size)
-        normalized = processed / 255.0
-        input_img = np.expand_dims(normalized, axis=[0, -1])
-        return input_img, processed 
\ No newline at end of file
+        processed = self.process_wave(img) if is_wave else self.process_spiral(img)
+        # Normalize straight into a float32 tensor; the reshape adds batch/channel axes without a copy
+        normalized = np.multiply(processed, 1.0 / 255.0, dtype=np.float32)
+        input_img = normalized.reshape(1, processed.shape[0], processed.shape[1], 1)
+        return input_img, processed
+
+    def _analyze(self, img, is_wave):
+        """Run prediction and Grad-CAM for one drawing."""
+        input_img, processed = self.prepare_image_for_prediction(img, is_wave=is_wave)
+        probs, heatmap_color = self.predict_and_gradcam(input_img, is_wave=is_wave)
+        return float(probs[0]), processed, heatmap_color
+
+    def analyze_spiral(self, img):
+        """Analyze a spiral drawing. Returns (prediction, processed image, colored heatmap)."""
+        return self._analyze(img, is_wave=False)
+
+    def analyze_wave(self, img):
+        """Analyze a wave drawing. Returns (prediction, processed image, colored heatmap)."""
+        return self._analyze(img, is_wave=True)
@@ -3,14 +3,26 @@ import os
 from tensorflow import keras
 import tensorflow as tf
 
+# Model input shapes as (batch, height, width, channels)
+SPIRAL_INPUT_SHAPE = (1, 256, 256, 1)
+WAVE_INPUT_SHAPE = (1, 250, 550, 1)
+
 class ModelLoader:
-    def __init__(self):
+    def __init__(self, precision='float32'):
+        # Keras dtype policy for the hidden layers: 'float32', or 'mixed_float16' to halve
+        # activation bandwidth on GPUs with float16 support
+        self.precision = precision
         self.spiral_model = None
         self.wave_model = None
+        # Grad-CAM sub-models exposing (last conv output, prediction), built once in load_models
+        self.spiral_gradcam_model = None
+        self.wave_gradcam_model = None
         # Spiral model has 4 conv layers: conv2d->conv2d_1->conv2d_2->conv2d_3 (32->64->128->256)
         self.spiral_last_conv = "conv2d_3"  # Last conv layer for spiral model (4th conv layer)
         # Wave model has 3 conv layers: conv2d->conv2d_1->conv2d_2 (32->64->128)
         self.wave_last_conv = "convo_3"     # Last conv layer for wave model (3rd conv layer)
+        # Weights are loaded and the Grad-CAM sub-models built. This does not mean the models are
+        # warm: the graphs that serve requests are traced and XLA-compiled by ImageProcessor.
         self.models_loaded = False
 
     def load_models(self):
@@ -34,10 +46,7 @@ class ModelLoader:
                     raise FileNotFoundError(f"Required model file not found: {file_path}")
 
             # Load spiral model
-            with open('models/spiral_config.json') as json_file:
-                spiral_config = json_file.read()
-            
-            self.spiral_model = keras.models.model_from_json(spiral_config)
+            self.spiral_model = self._model_from_config('models/spiral_config.json')
             if self.spiral_model is None:
                 raise ValueError("Failed to create spiral model from config")
                 
@@ -45,59 +54,55 @@ class ModelLoader:
             print("Spiral model loaded successfully")
 
             # Load wave model
-            with open('models/wave_config.json') as json_file:
-                wave_config = json_file.read()
-            
-            self.wave_model = keras.models.model_from_json(wave_config)
+            self.wave_model = self._model_from_config('models/wave_config.json')
             if self.wave_model is None:
                 raise ValueError("Failed to create wave model from config")
                 
             self.wave_model.load_weights('models/wave.weights.new.h5')  # Using new weight file
             print("Wave model loaded successfully")
 
-            # Configure optimizer
-            optimizer_config = {
-                'learning_rate': 0.001,
-                'beta_1': 0.9,
-                'beta_2': 0.999,
-                'epsilon': 1e-07,
-                'amsgrad': False
-            }
-            optimizer = keras.optimizers.Adam(**optimizer_config)
-
-            # Compile models
-            self.spiral_model.compile(
-                optimizer=optimizer,
-                loss='binary_crossentropy',
-                metrics=['accuracy']
-            )
-            
-            self.wave_model.compile(
-                optimizer=optimizer,
-                loss='binary_crossentropy',
-                metrics=['accuracy']
-            )
-
-            # Test predictions
-            test_input = tf.zeros((1, 256, 256, 1))  # Test input for spiral model
-            _ = self.spiral_model.predict(test_input)
-            print("Spiral model prediction test successful")
-
-            test_input = tf.zeros((1, 250, 550, 1))  # Test input for wave model
-            _ = self.wave_model.predict(test_input)
-            print("Wave model prediction test successful")
+            # Build the Grad-CAM sub-models once so requests don't re-trace the network
+            self.spiral_gradcam_model = self._build_gradcam_model(self.spiral_model, self.spiral_last_conv)
+            self.wave_gradcam_model = self._build_gradcam_model(self.wave_model, self.wave_last_conv)
+            print("Grad-CAM models built successfully")
 
+            # Models are inference-only, so they are never compiled: no optimizer slots or metric state.
+            # Predictions come from the XLA-compiled Grad-CAM pass in ImageProcessor, which also
+            # runs the startup warmup; build an ImageProcessor with this loader before serving.
             self.models_loaded = True
-            print("All models loaded and tested successfully")
+            print("All models loaded successfully (not yet warmed up)")
             return True
 
         except Exception as e:
             print(f"Error loading models: {str(e)}")
             self.spiral_model = None
             self.wave_model = None
+            self.spiral_gradcam_model = None
+            self.wave_gradcam_model = None
             self.models_loaded = False
             return False
 
+    def _model_from_config(self, config_path):
+        """Create a model from its JSON config, applying the configured precision."""
+        with open(config_path) as json_file:
+            config = json.load(json_file)
+
+        if self.precision != 'float32':
+            # The configs pin every layer to float32, which overrides any global policy.
+            # Keep the input and the sigmoid output layer in float32 for numeric stability.
+            for layer in config['config']['layers'][1:-1]:
+                layer['config']['dtype'] = self.precision
+
+        return keras.models.model_from_json(json.dumps(config))
+
+    @staticmethod
+    def _build_gradcam_model(model, last_conv_layer_name):
+        """Build a model returning both the last conv layer output and the prediction."""
+        return keras.Model(
+            inputs=model.input,
+            outputs=[model.get_layer(last_conv_layer_name).output, model.output]
+        )
+
     def get_spiral_model(self):
         """Get the spiral analysis model."""
         if not self.models_loaded:
@@ -114,6 +119,22 @@ class ModelLoader:
                 raise RuntimeError("Failed to load models")
         return self.wave_model
 
+    def get_spiral_gradcam_model(self):
+        """Get the Grad-CAM sub-model for the spiral model."""
+        if not self.models_loaded:
+            success = self.load_models()
+            if not success:
+                raise RuntimeError("Failed to load models")
+        return self.spiral_gradcam_model
+
+    def get_wave_gradcam_model(self):
+        """Get the Grad-CAM sub-model for the wave model."""
+        if not self.models_loaded:
+            success = self.load_models()
+            if not success:
+                raise RuntimeError("Failed to load models")
+        return self.wave_gradcam_model
+
     def get_last_conv_layer(self, is_wave=False):
         """Get the name of the last convolutional layer for Grad-CAM."""
         return self.wave_last_conv if is_wave else self.spiral_last_conv 
\ No newline at end of file